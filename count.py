@@ -1,37 +1,61 @@
 import boto3
 import os
+import threading
 from tqdm import tqdm
 from dotenv import load_dotenv
 
+from s3_listing import S3_CLIENT_CONFIG, count_inventory_keys, list_objects_sharded
+
 load_dotenv()
 
 s3 = boto3.client(
     's3',
     aws_access_key_id=os.getenv("S3_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("S3_SECRET_ACCESS_KEY")
+    aws_secret_access_key=os.getenv("S3_SECRET_ACCESS_KEY"),
+    config=S3_CLIENT_CONFIG,
 )
 
 BUCKET_NAME = "fink-hotel-invoice-scraped"
 PREFIX = "" # Keep empty to scan entire bucket
+S3_INVENTORY_URI = os.getenv("S3_INVENTORY_URI") # Inventory manifest.json or config prefix; skips LIST entirely
+
+def count_from_inventory():
+    print(f"📦 Reading S3 Inventory report at '{S3_INVENTORY_URI}'...")
+    return count_inventory_keys(
+        S3_INVENTORY_URI,
+        prefix=PREFIX,
+        access_key=os.getenv("S3_ACCESS_KEY_ID"),
+        secret_key=os.getenv("S3_SECRET_ACCESS_KEY"),
+    )
 
 def count_pdfs():
     print(f"🔍 Counting PDF objects in '{BUCKET_NAME}'...")
-    paginator = s3.get_paginator('list_objects_v2')
+
+    if S3_INVENTORY_URI:
+        total_objects_scanned, pdf_count = count_from_inventory()
+        print_results(total_objects_scanned, pdf_count)
+        return
     
     pdf_count = 0
     total_objects_scanned = 0
+    lock = threading.Lock()
+
+    # Key-range shards are listed concurrently; pages arrive from worker threads
+    def tally(contents):
+        nonlocal pdf_count, total_objects_scanned
 
-    # Using tqdm for a live update in the terminal
-    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=PREFIX):
-        contents = page.get('Contents', [])
-        total_objects_scanned += len(contents)
-        
         # Filter for PDFs only
         pdfs_in_page = [obj for obj in contents if obj['Key'].lower().endswith('.pdf')]
-        pdf_count += len(pdfs_in_page)
-        
-        print(f"Processed: {total_objects_scanned} | Found PDFs: {pdf_count}", end="\r")
 
+        with lock:
+            total_objects_scanned += len(contents)
+            pdf_count += len(pdfs_in_page)
+            print(f"Processed: {total_objects_scanned} | Found PDFs: {pdf_count}", end="\r")
+
+    list_objects_sharded(s3, BUCKET_NAME, PREFIX, tally)
+    print_results(total_objects_scanned, pdf_count)
+
+def print_results(total_objects_scanned, pdf_count):
     print(f"\n\n📊 Final Results:")
     print(f"Total Objects in Bucket: {total_objects_scanned}")
     print(f"Total PDF Invoices:      {pdf_count}")
@@ -6,43 +6,68 @@ Gemini 2.5 Pro via Vertex AI, and saves structured "Silver" JSON labels
 to ./silver_labels.
 
 Authentication:
-    Uses the service-account key at ./credentials.json via the
-    GOOGLE_APPLICATION_CREDENTIALS environment variable (set at runtime).
+    Loads the service-account key at ./credentials.json once into a
+    Credentials object and passes it to the Vertex AI and GCS clients.
 
 Usage:
-    python generate_silver_labels.py
+    python generate_silver_labels.py                 # online calls (default)
+    python generate_silver_labels.py --mode=batch    # Vertex AI Batch Prediction
+
+Batch mode stages the PDFs in GCS_STAGING_URI (e.g. gs://my-bucket/silver),
+runs one Batch Prediction job over all of them, and writes the results to
+./silver_labels. It is not subject to the online RPM quota.
 """
 
 import os
 import sys
 import json
+import argparse
+import time
 import base64
 import logging
 import pathlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from dotenv import load_dotenv
 
 # Load environment variables from .env
 load_dotenv()
 
-from google.cloud import aiplatform
+from google.cloud import aiplatform, storage
 from google.api_core.exceptions import ResourceExhausted, GoogleAPICallError
+from google.oauth2 import service_account
 from vertexai.generative_models import (
     GenerativeModel,
     Part,
     GenerationConfig,
 )
 import vertexai
+from vertexai.batch_prediction import BatchPredictionJob
 
+import orjson
 from tqdm import tqdm
 from tenacity import (
     retry,
     stop_after_attempt,
-    wait_exponential,
+    wait_random_exponential,
     retry_if_exception_type,
     before_sleep_log,
 )
 
+from template_hashing import (
+    HASH_ALGORITHM,
+    HASH_THRESHOLD,
+    PHASH_CACHE_FILENAME,
+    cache_phash,
+    cached_phash,
+    compute_template_hash,
+    load_phash_cache,
+    new_template_index,
+    save_phash_cache,
+)
+
 # ============================================================================
 # CONFIGURATION
 # ============================================================================
@@ -55,6 +80,47 @@ OUTPUT_DIR = pathlib.Path("./silver_labels")
 CREDENTIALS_PATH = pathlib.Path("./credentials.json")
 FAILED_LOG = pathlib.Path("./failed_extractions.log")
 
+# Machine-readable failure history, one JSON object per failed attempt.
+# PDFs whose last failure was a PERMANENT_FAILURE_TYPES error are skipped on
+# rerun unless --retry-failed is given; quota, API and batch-row errors
+# (BATCH_ROW_ERROR: a Batch Prediction row with an error status or no
+# candidates, often quota or internal) are retried.
+FAILED_JSONL = pathlib.Path("./failed.jsonl")
+PERMANENT_FAILURE_TYPES = {"JSON_PARSE_ERROR", "UNEXPECTED_ERROR"}
+
+# --dedup: layout-hash cache shared with unique_template_discovery.py, and the
+# member -> representative map persisted so reruns keep stable classes. The map
+# records HASH_ALGORITHM and is discarded when the hash algorithm changes.
+PHASH_CACHE_PATH = TEMPLATES_DIR / PHASH_CACHE_FILENAME
+TEMPLATE_CLASSES_PATH = TEMPLATES_DIR / ".template_classes.json"
+
+# Number of PDFs in flight at once. Calls are network-bound, so this is
+# limited by the Vertex AI quota rather than local CPU.
+MAX_WORKERS = int(os.getenv("SILVER_MAX_WORKERS", "16"))
+
+# PDFs sent per Gemini request. The RPM quota counts requests, not documents,
+# so batching small invoices multiplies throughput. 1 disables batching.
+BATCH_SIZE = int(os.getenv("SILVER_BATCH_SIZE", "3"))
+
+# Requests-per-minute quota for the model on Vertex AI. All workers share a
+# single token bucket that refills at VERTEX_RPM / 60 per second and holds at
+# most VERTEX_RATE_BURST tokens, so even the first minute stays within quota.
+VERTEX_RATE_BURST = int(os.getenv("VERTEX_RATE_BURST", "1"))
+VERTEX_RPM = int(os.getenv("VERTEX_RPM", "200"))
+
+# After this many consecutive ResourceExhausted errors (across all workers),
+# every worker pauses for QUOTA_COOLDOWN_SECONDS before calling again.
+QUOTA_BREAKER_THRESHOLD = 3
+QUOTA_COOLDOWN_SECONDS = 30.0
+
+# Batch mode: GCS prefix used to stage input PDFs, the request manifest and
+# the job output, plus how often to poll the job while it runs.
+GCS_STAGING_URI = os.getenv("GCS_STAGING_URI", "")
+BATCH_POLL_SECONDS = 60
+
+# Resource name of a submitted batch job, kept until its output is collected
+BATCH_JOB_STATE = pathlib.Path("./batch_job.json")
+
 # ============================================================================
 # LOGGING SETUP
 # ============================================================================
@@ -202,6 +268,33 @@ HOTEL_INVOICE_SCHEMA = {
     ],
 }
 
+# Built once at import: the schema is marshalled to protobuf when the config is
+# constructed, so sharing one instance avoids redoing that on every request.
+GENERATION_CONFIG = GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=HOTEL_INVOICE_SCHEMA,
+    temperature=0.0,
+)
+
+# Batched requests return one HOTEL_INVOICE_SCHEMA object per input PDF, in order.
+BATCH_INVOICE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "invoices": {
+            "type": "array",
+            "description": "One entry per input invoice PDF, in the order they were given.",
+            "items": HOTEL_INVOICE_SCHEMA,
+        },
+    },
+    "required": ["invoices"],
+}
+
+BATCH_GENERATION_CONFIG = GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=BATCH_INVOICE_SCHEMA,
+    temperature=0.0,
+)
+
 # ============================================================================
 # EXTRACTION PROMPT
 # ============================================================================
@@ -220,31 +313,168 @@ RULES:
 
 Extract the data now."""
 
+BATCH_PROMPT_SUFFIX = """
+
+BATCH MODE:
+You have been given {count} separate invoice PDFs, each preceded by a label "Invoice N".
+Return exactly {count} entries in the "invoices" array, one per PDF, in the same order as the labels.
+Never merge or copy data between invoices."""
+
+# ============================================================================
+# RATE LIMITING
+# ============================================================================
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket admitting `rate` calls per `period` seconds.
+
+    Tokens refill continuously and the bucket holds at most `burst` of them,
+    so callers are admitted at a steady rate / period pace from the very
+    first call instead of bursting into ResourceExhausted errors. Any window
+    of `period` seconds admits at most rate + burst calls.
+    """
+
+    def __init__(self, rate: int, period: float = 60.0, burst: int = 1) -> None:
+        self.capacity = float(burst)
+        self.refill_per_sec = rate / period
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available, then consume it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated_at) * self.refill_per_sec,
+                )
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait_for = (1 - self.tokens) / self.refill_per_sec
+
+            time.sleep(wait_for)
+
+
+class CircuitBreaker:
+    """
+    Process-wide pause switch for quota exhaustion.
+
+    Retries with backoff are per worker, so under concurrency the other
+    workers keep hitting the exhausted quota. After `threshold` consecutive
+    ResourceExhausted errors the breaker opens and every worker blocks in
+    wait() until `cooldown` seconds have passed.
+    """
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.closed = threading.Event()
+        self.closed.set()
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block while the breaker is open."""
+        self.closed.wait()
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.consecutive_failures = 0
+
+    def record_quota_error(self) -> None:
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures < self.threshold or not self.closed.is_set():
+                return
+
+            self.consecutive_failures = 0
+            self.closed.clear()
+
+        logger.warning(
+            f"CIRCUIT_OPEN | {self.threshold} consecutive quota errors | "
+            f"pausing all workers for {self.cooldown:.0f}s"
+        )
+        timer = threading.Timer(self.cooldown, self.closed.set)
+        timer.daemon = True
+        timer.start()
+
+
+vertex_rate_limiter = TokenBucket(VERTEX_RPM, period=60.0, burst=VERTEX_RATE_BURST)
+quota_breaker = CircuitBreaker(QUOTA_BREAKER_THRESHOLD, QUOTA_COOLDOWN_SECONDS)
+
+
+def rate_limited(limiter: TokenBucket):
+    """Decorator that acquires one token from `limiter` before each call."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            limiter.acquire()
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def guarded_by(breaker: CircuitBreaker):
+    """Decorator that waits on `breaker` and reports quota errors to it."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            breaker.wait()
+            try:
+                result = func(*args, **kwargs)
+            except ResourceExhausted:
+                breaker.record_quota_error()
+                raise
+            breaker.record_success()
+            return result
+
+        return wrapper
+
+    return decorator
+
+
 # ============================================================================
 # CORE FUNCTIONS
 # ============================================================================
 
 
-def init_vertex_ai() -> None:
-    """Initialize Vertex AI SDK with project credentials."""
+def init_vertex_ai() -> service_account.Credentials:
+    """
+    Initialize Vertex AI SDK with project credentials.
+
+    The key file is parsed once here; the returned Credentials object is
+    shared by every client, so token refreshes never re-read it.
+    """
     if not CREDENTIALS_PATH.exists():
         raise FileNotFoundError(
             f"Credentials file not found at {CREDENTIALS_PATH}. "
             "Place your service account JSON key there."
         )
 
-    # Load project_id directly from the service account credentials
-    with open(CREDENTIALS_PATH, "r", encoding="utf-8") as f:
-        creds_data = json.load(f)
-        project_id = creds_data.get("project_id")
-        
+    credentials = service_account.Credentials.from_service_account_file(
+        str(CREDENTIALS_PATH),
+        scopes=["https://www.googleapis.com/auth/cloud-platform"],
+    )
+
+    # project_id comes directly from the service account credentials
+    project_id = credentials.project_id
     if not project_id:
         raise ValueError("The key 'project_id' was not found in credentials.json.")
 
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = str(CREDENTIALS_PATH.resolve())
-
-    vertexai.init(project=project_id, location=LOCATION)
+    vertexai.init(project=project_id, location=LOCATION, credentials=credentials)
     logger.info(f"Vertex AI initialized | project={project_id} | location={LOCATION}")
+    return credentials
 
 
 def get_pdf_files() -> list[pathlib.Path]:
@@ -257,6 +487,12 @@ def get_pdf_files() -> list[pathlib.Path]:
     return pdf_files
 
 
+def list_existing_labels() -> set[str]:
+    """Names of label files already in OUTPUT_DIR, from a single directory scan."""
+    with os.scandir(OUTPUT_DIR) as entries:
+        return {entry.name for entry in entries if entry.name.endswith(".json")}
+
+
 def load_pdf_as_part(pdf_path: pathlib.Path) -> Part:
     """Read a local PDF and return it as a Vertex AI Part with inline data."""
     return Part.from_data(data=pdf_path.read_bytes(), mime_type="application/pdf")
@@ -264,62 +500,555 @@ def load_pdf_as_part(pdf_path: pathlib.Path) -> Part:
 
 @retry(
     retry=retry_if_exception_type(ResourceExhausted),
-    wait=wait_exponential(multiplier=2, min=5, max=120),
+    wait=wait_random_exponential(multiplier=2, min=5, max=120),
     stop=stop_after_attempt(5),
     before_sleep=before_sleep_log(logger, logging.WARNING),
     reraise=True,
 )
-def call_vertex_api(model: GenerativeModel, pdf_part: Part) -> str:
+@guarded_by(quota_breaker)
+@rate_limited(vertex_rate_limiter)
+def call_vertex_api(
+    model: GenerativeModel,
+    contents: list,
+    generation_config: GenerationConfig = GENERATION_CONFIG,
+) -> str:
     """
-    Send a PDF to Gemini via Vertex AI and return the raw JSON string.
+    Send PDF part(s) and the prompt to Gemini via Vertex AI and return the raw JSON string.
 
-    Retries up to 5 times with exponential backoff on ResourceExhausted
-    (quota) errors. All other exceptions propagate immediately.
+    Every attempt (including retries) waits while the quota circuit breaker
+    is open, then takes a token from the shared rate limiter. Retries up to
+    5 times with jittered exponential backoff on ResourceExhausted (quota)
+    errors. All other exceptions propagate immediately.
     """
-    generation_config = GenerationConfig(
-        response_mime_type="application/json",
-        response_schema=HOTEL_INVOICE_SCHEMA,
-        temperature=0.0,
-    )
-
     response = model.generate_content(
-        [pdf_part, EXTRACTION_PROMPT],
+        contents,
         generation_config=generation_config,
     )
 
     return response.text
 
 
+def save_label(result: dict, output_path: pathlib.Path) -> None:
+    """Write a silver label to disk."""
+    # orjson emits UTF-8 directly (no ASCII escaping), like ensure_ascii=False
+    with open(output_path, "wb") as f:
+        f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+
+
+# Last failure record per PDF name; loaded in main(), updated by workers.
+failure_history: dict[str, dict] = {}
+failure_lock = threading.Lock()
+
+
+def load_failure_history() -> dict[str, dict]:
+    """Return the most recent failure record per PDF name from FAILED_JSONL."""
+    history: dict[str, dict] = {}
+    if not FAILED_JSONL.exists():
+        return history
+
+    for line in FAILED_JSONL.read_text(encoding="utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue  # Blank or partially written line from an interrupted run
+        history[record["pdf"]] = record
+    return history
+
+
+def record_failure(pdf_path: pathlib.Path, error_type: str, e: Exception) -> None:
+    """Append one failure record to FAILED_JSONL (thread-safe)."""
+    with failure_lock:
+        previous = failure_history.get(pdf_path.name, {})
+        record = {
+            "pdf": pdf_path.name,
+            "error_type": error_type,
+            "error": f"{type(e).__name__}: {e}",
+            "ts": datetime.now().isoformat(),
+            "attempt": previous.get("attempt", 0) + 1,
+        }
+        failure_history[pdf_path.name] = record
+        with open(FAILED_JSONL, "ab") as f:
+            f.write(orjson.dumps(record) + b"\n")
+
+
+def log_failure(pdf_path: pathlib.Path, e: Exception, error_type: str | None = None) -> None:
+    """
+    Log an extraction failure to failed_extractions.log and failed.jsonl.
+
+    error_type overrides the classification by exception type.
+    """
+    if error_type is not None:
+        logger.warning(f"{error_type} | {pdf_path.name} | {type(e).__name__}: {e}")
+    elif isinstance(e, ResourceExhausted):
+        error_type = "QUOTA_EXHAUSTED"
+        logger.warning(f"QUOTA_EXHAUSTED | {pdf_path.name} | {e}")
+    elif isinstance(e, GoogleAPICallError):
+        error_type = "API_ERROR"
+        logger.warning(f"API_ERROR | {pdf_path.name} | {type(e).__name__}: {e}")
+    elif isinstance(e, json.JSONDecodeError):
+        error_type = "JSON_PARSE_ERROR"
+        logger.warning(f"JSON_PARSE_ERROR | {pdf_path.name} | {e}")
+    else:
+        error_type = "UNEXPECTED_ERROR"
+        logger.warning(f"UNEXPECTED_ERROR | {pdf_path.name} | {type(e).__name__}: {e}")
+
+    record_failure(pdf_path, error_type, e)
+
+
 def extract_single_invoice(
-    model: GenerativeModel, pdf_path: pathlib.Path
+    model: GenerativeModel, pdf_path: pathlib.Path, output_path: pathlib.Path
 ) -> dict | None:
     """
     End-to-end extraction for a single PDF.
 
+    Safe to run from worker threads: the parsed result is written to
+    output_path inside the worker so file I/O overlaps with other calls.
+
     Returns the parsed JSON dict on success, or None on failure.
     Failures are logged to the failed_extractions.log file.
     """
     try:
         pdf_part = load_pdf_as_part(pdf_path)
-        raw_json = call_vertex_api(model, pdf_part)
+        raw_json = call_vertex_api(model, [pdf_part, EXTRACTION_PROMPT])
         parsed = json.loads(raw_json)
+        save_label(parsed, output_path)
         return parsed
 
-    except ResourceExhausted as e:
-        logger.warning(f"QUOTA_EXHAUSTED | {pdf_path.name} | {e}")
+    except Exception as e:
+        log_failure(pdf_path, e)
         return None
 
-    except GoogleAPICallError as e:
-        logger.warning(f"API_ERROR | {pdf_path.name} | {type(e).__name__}: {e}")
-        return None
 
-    except json.JSONDecodeError as e:
-        logger.warning(f"JSON_PARSE_ERROR | {pdf_path.name} | {e}")
-        return None
+def extract_batch(
+    model: GenerativeModel, tasks: list[tuple[pathlib.Path, pathlib.Path]]
+) -> list[dict | None]:
+    """
+    Extract several PDFs with a single Gemini request.
+
+    Each PDF is preceded by an "Invoice N" label and the response's
+    "invoices" array is split back by index. If the response cannot be
+    parsed or has the wrong number of entries, every PDF in the batch is
+    retried on its own via extract_single_invoice.
+
+    Returns one parsed dict (or None on failure) per task, in order.
+    """
+    if len(tasks) == 1:
+        return [extract_single_invoice(model, *tasks[0])]
+
+    try:
+        contents = []
+        for i, (pdf_path, _) in enumerate(tasks, start=1):
+            contents.extend([f"Invoice {i}:", load_pdf_as_part(pdf_path)])
+        contents.append(EXTRACTION_PROMPT + BATCH_PROMPT_SUFFIX.format(count=len(tasks)))
+
+        raw_json = call_vertex_api(model, contents, BATCH_GENERATION_CONFIG)
+        invoices = json.loads(raw_json)["invoices"]
+        if len(invoices) != len(tasks):
+            raise ValueError(f"expected {len(tasks)} invoices, got {len(invoices)}")
+
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        names = ", ".join(pdf_path.name for pdf_path, _ in tasks)
+        logger.warning(f"BATCH_FALLBACK | {names} | {type(e).__name__}: {e}")
+        return [extract_single_invoice(model, *task) for task in tasks]
 
     except Exception as e:
-        logger.warning(f"UNEXPECTED_ERROR | {pdf_path.name} | {type(e).__name__}: {e}")
-        return None
+        for pdf_path, _ in tasks:
+            log_failure(pdf_path, e)
+        return [None] * len(tasks)
+
+    results: list[dict | None] = []
+    for (pdf_path, output_path), parsed in zip(tasks, invoices):
+        try:
+            save_label(parsed, output_path)
+            results.append(parsed)
+        except Exception as e:
+            log_failure(pdf_path, e)
+            results.append(None)
+    return results
+
+
+# ============================================================================
+# TEMPLATE DEDUPLICATION
+# ============================================================================
+
+
+def load_template_classes() -> dict[str, str]:
+    """
+    Return the member -> representative name map saved by the previous run.
+
+    Maps built with another hash algorithm (or before the algorithm was
+    recorded, i.e. pHash) are ignored so classes are regrouped from scratch.
+    """
+    try:
+        saved = json.loads(TEMPLATE_CLASSES_PATH.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+    if saved.get("algo") != HASH_ALGORITHM:
+        logger.info(f"Ignoring {TEMPLATE_CLASSES_PATH.name}: built with another hash algorithm")
+        return {}
+    return saved["classes"]
+
+
+def save_template_classes(classes: dict[pathlib.Path, pathlib.Path]) -> None:
+    """Persist the member -> representative map alongside HASH_ALGORITHM."""
+    payload = {
+        "algo": HASH_ALGORITHM,
+        "classes": {m.name: r.name for m, r in classes.items()},
+    }
+    # Write-then-rename so an interrupted run never leaves a truncated map
+    tmp_path = TEMPLATE_CLASSES_PATH.with_name(TEMPLATE_CLASSES_PATH.name + ".tmp")
+    tmp_path.write_bytes(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, TEMPLATE_CLASSES_PATH)
+
+
+def group_templates(pdf_files: list[pathlib.Path]) -> dict[pathlib.Path, pathlib.Path]:
+    """
+    Map every PDF to the representative of its near-duplicate class.
+
+    Uses the same first-page hash and HASH_THRESHOLD as template discovery,
+    reusing its hash cache where the file is unchanged. Representatives from
+    the previous run are seeded first so their members keep their class (and
+    their already-extracted label). PDFs that cannot be rendered form their
+    own class.
+    """
+    by_name = {pdf_path.name: pdf_path for pdf_path in pdf_files}
+
+    previous = load_template_classes()
+
+    previous_reps = [by_name[name] for name in dict.fromkeys(previous.values()) if name in by_name]
+    seeded = set(previous_reps)
+    ordered = previous_reps + [p for p in pdf_files if p not in seeded]
+
+    phash_cache = load_phash_cache(PHASH_CACHE_PATH)
+    index = new_template_index()
+    rep_by_hash: dict[int, pathlib.Path] = {}
+    classes: dict[pathlib.Path, pathlib.Path] = {}
+
+    for pdf_path in tqdm(ordered, desc="Grouping templates", unit="file"):
+        prev_rep = by_name.get(previous.get(pdf_path.name, ""))
+        if prev_rep is not None and classes.get(prev_rep) == prev_rep:
+            classes[pdf_path] = prev_rep
+            continue
+
+        phash = cached_phash(phash_cache, pdf_path)
+        if phash is None:
+            try:
+                phash = compute_template_hash(pdf_path)
+            except Exception as e:
+                logger.warning(f"HASH_ERROR | {pdf_path.name} | {type(e).__name__}: {e}")
+            if phash is not None:
+                cache_phash(phash_cache, pdf_path, phash)
+
+        if phash is None:
+            classes[pdf_path] = pdf_path
+            continue
+
+        matches = index.find(phash, HASH_THRESHOLD)
+        if matches:
+            # find() returns (distance, hash) pairs sorted by distance
+            classes[pdf_path] = rep_by_hash[matches[0][1]]
+        else:
+            index.add(phash)
+            rep_by_hash[phash] = pdf_path
+            classes[pdf_path] = pdf_path
+
+    save_phash_cache(phash_cache, PHASH_CACHE_PATH)
+    save_template_classes(classes)
+
+    logger.info(f"Grouped {len(pdf_files)} PDFs into {len(rep_by_hash)} hashed template classes")
+    return classes
+
+
+def promote_representatives(
+    classes: dict[pathlib.Path, pathlib.Path], done: set[str], retry_failed: bool
+) -> int:
+    """
+    Replace representatives that failed permanently and have no label.
+
+    Otherwise every member of such a class would be counted as a duplicate
+    and never labelled. The new representative is a member that already has
+    a label if there is one, else the first member not itself permanently
+    failed; the old representative becomes an ordinary member and gets a
+    copied label like the rest. Updates `classes` in place, persists it and
+    returns the number of classes changed. With --retry-failed the original
+    representatives are simply retried.
+    """
+    if retry_failed:
+        return 0
+
+    def failed_permanently(pdf_path: pathlib.Path) -> bool:
+        last_failure = failure_history.get(pdf_path.name)
+        return last_failure is not None and last_failure["error_type"] in PERMANENT_FAILURE_TYPES
+
+    def has_label(pdf_path: pathlib.Path) -> bool:
+        return pdf_path.with_suffix(".json").name in done
+
+    members_by_rep: dict[pathlib.Path, list[pathlib.Path]] = {}
+    for member, rep in classes.items():
+        if member != rep:
+            members_by_rep.setdefault(rep, []).append(member)
+
+    promoted = 0
+    for rep, members in members_by_rep.items():
+        if has_label(rep) or not failed_permanently(rep):
+            continue
+
+        candidates = [m for m in members if has_label(m)] or [
+            m for m in members if not failed_permanently(m)
+        ]
+        if not candidates:
+            continue
+
+        new_rep = candidates[0]
+        for member in members + [rep]:
+            classes[member] = new_rep
+        logger.info(f"PROMOTED | {new_rep.name} replaces failed representative {rep.name}")
+        promoted += 1
+
+    if promoted:
+        save_template_classes(classes)
+    return promoted
+
+
+def propagate_labels(classes: dict[pathlib.Path, pathlib.Path]) -> int:
+    """
+    Copy each representative's label to class members that lack one.
+
+    Copies carry "source_pdf" (the member) and "copied_from" (the
+    representative) so HITL review can tell them apart from direct
+    extractions. Returns the number of labels written.
+    """
+    copied = 0
+    done = list_existing_labels()
+    for member, rep in classes.items():
+        if member == rep:
+            continue
+
+        member_output = OUTPUT_DIR / member.with_suffix(".json").name
+        rep_output = OUTPUT_DIR / rep.with_suffix(".json").name
+        if member_output.name in done or rep_output.name not in done:
+            continue
+
+        label = orjson.loads(rep_output.read_bytes())
+        label["source_pdf"] = member.name
+        label["copied_from"] = rep.name
+        save_label(label, member_output)
+        copied += 1
+
+    return copied
+
+
+# ============================================================================
+# BATCH PREDICTION MODE
+# ============================================================================
+
+
+def split_gcs_uri(uri: str) -> tuple[str, str]:
+    """Split gs://bucket/some/prefix into ("bucket", "some/prefix")."""
+    if not uri.startswith("gs://"):
+        raise ValueError(f"Expected a gs:// URI, got: {uri!r}")
+    bucket, _, prefix = uri[len("gs://"):].partition("/")
+    return bucket, prefix.rstrip("/")
+
+
+def build_batch_request(pdf_uri: str) -> dict:
+    """One line of the Batch Prediction input manifest."""
+    return {
+        "request": {
+            "contents": [
+                {
+                    "role": "user",
+                    "parts": [
+                        {"fileData": {"fileUri": pdf_uri, "mimeType": "application/pdf"}},
+                        {"text": EXTRACTION_PROMPT},
+                    ],
+                }
+            ],
+            "generationConfig": GENERATION_CONFIG.to_dict(),
+        }
+    }
+
+
+def submit_batch_job(
+    tasks: list[tuple[pathlib.Path, pathlib.Path]],
+    gcs: storage.Client,
+) -> BatchPredictionJob:
+    """Upload the PDFs and a requests.jsonl manifest under GCS_STAGING_URI and submit the job."""
+    bucket_name, base_prefix = split_gcs_uri(GCS_STAGING_URI)
+    run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    run_prefix = f"{base_prefix}/{run_id}" if base_prefix else run_id
+    bucket = gcs.bucket(bucket_name)
+
+    # --- Upload PDFs (network-bound, so in parallel) ---
+    def upload(task: tuple[pathlib.Path, pathlib.Path]) -> str:
+        blob_name = f"{run_prefix}/pdfs/{task[0].name}"
+        bucket.blob(blob_name).upload_from_filename(
+            str(task[0]), content_type="application/pdf"
+        )
+        return f"gs://{bucket_name}/{blob_name}"
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        pdf_uris = list(
+            tqdm(executor.map(upload, tasks), total=len(tasks), desc="Uploading PDFs", unit="file")
+        )
+
+    manifest = "\n".join(
+        orjson.dumps(build_batch_request(pdf_uri)).decode() for pdf_uri in pdf_uris
+    )
+    bucket.blob(f"{run_prefix}/requests.jsonl").upload_from_string(
+        manifest, content_type="application/jsonl"
+    )
+
+    job = BatchPredictionJob.submit(
+        source_model=MODEL_ID,
+        input_dataset=f"gs://{bucket_name}/{run_prefix}/requests.jsonl",
+        output_uri_prefix=f"gs://{bucket_name}/{run_prefix}/output",
+    )
+
+    # Persist the job so an interrupted run reattaches instead of paying again
+    BATCH_JOB_STATE.write_text(
+        json.dumps({"job": job.resource_name, "pdfs": len(tasks)}, indent=2), encoding="utf-8"
+    )
+    logger.info(f"Batch job submitted | {job.resource_name} | saved to {BATCH_JOB_STATE}")
+    return job
+
+
+def run_batch_prediction(
+    tasks: list[tuple[pathlib.Path, pathlib.Path]],
+    credentials: service_account.Credentials,
+    job_name: str | None = None,
+) -> tuple[int, int]:
+    """
+    Extract PDFs with a single Vertex AI Batch Prediction job.
+
+    1. Reattach to job_name (or the job saved in BATCH_JOB_STATE by an
+       interrupted run), otherwise upload the tasks and submit a new job
+    2. Poll until the job ends
+    3. Read the prediction files and save each label to OUTPUT_DIR, matching
+       rows to PDFs by the staged file name
+
+    Returns (success_count, fail_count).
+    """
+    if not GCS_STAGING_URI and job_name is None and not BATCH_JOB_STATE.exists():
+        raise ValueError("Set GCS_STAGING_URI (gs://bucket/prefix) to use --mode=batch.")
+
+    gcs = storage.Client(project=credentials.project_id, credentials=credentials)
+
+    if job_name is None and BATCH_JOB_STATE.exists():
+        job_name = json.loads(BATCH_JOB_STATE.read_text(encoding="utf-8"))["job"]
+
+    if job_name is not None:
+        job = BatchPredictionJob(job_name)
+        logger.info(f"Reattached to batch job | {job.resource_name}")
+        expected = None  # The job's input may differ from this run's pending PDFs
+    else:
+        job = submit_batch_job(tasks, gcs)
+        expected = len(tasks)
+
+    # --- Wait ---
+    while not job.has_ended:
+        time.sleep(BATCH_POLL_SECONDS)
+        job.refresh()
+        logger.info(f"Batch job state | {job.state.name}")
+
+    if not job.has_succeeded:
+        logger.warning(f"BATCH_JOB_FAILED | {job.resource_name} | {job.error}")
+        BATCH_JOB_STATE.unlink(missing_ok=True)
+        return 0, expected if expected is not None else len(tasks)
+
+    # --- Collect results ---
+    success_count = 0
+    fail_count = 0
+    output_bucket_name, output_prefix = split_gcs_uri(job.output_location)
+
+    for blob in gcs.bucket(output_bucket_name).list_blobs(prefix=output_prefix):
+        if not blob.name.endswith(".jsonl"):
+            continue
+
+        for line_number, line in enumerate(blob.download_as_text().splitlines(), start=1):
+            if not line.strip():
+                continue
+
+            try:
+                record = json.loads(line)
+                pdf_uri = record["request"]["contents"][0]["parts"][0]["fileData"]["fileUri"]
+            except Exception as e:
+                # A malformed row must not abort collecting the rest of the job
+                logger.warning(
+                    f"BATCH_OUTPUT_UNREADABLE | {blob.name}:{line_number} | "
+                    f"{type(e).__name__}: {e}"
+                )
+                fail_count += 1
+                continue
+
+            pdf_path = TEMPLATES_DIR / pdf_uri.rsplit("/", 1)[-1]
+            output_path = OUTPUT_DIR / pdf_path.with_suffix(".json").name
+
+            try:
+                if record.get("status"):
+                    raise RuntimeError(record["status"])
+                raw_json = record["response"]["candidates"][0]["content"]["parts"][0]["text"]
+            except Exception as e:
+                # Row-level job errors are usually transient; keep them retryable
+                log_failure(pdf_path, e, error_type="BATCH_ROW_ERROR")
+                fail_count += 1
+                continue
+
+            try:
+                save_label(json.loads(raw_json), output_path)
+                success_count += 1
+            except Exception as e:
+                log_failure(pdf_path, e)
+                fail_count += 1
+
+    BATCH_JOB_STATE.unlink(missing_ok=True)
+
+    # PDFs missing from the job output count as failures too
+    if expected is not None:
+        fail_count = max(fail_count, expected - success_count)
+    return success_count, fail_count
+
+
+def run_online(
+    model: GenerativeModel, tasks: list[tuple[pathlib.Path, pathlib.Path]]
+) -> tuple[int, int]:
+    """Extract tasks with concurrent online calls. Returns (success_count, fail_count)."""
+    success_count = 0
+    fail_count = 0
+
+    batches = [tasks[i : i + BATCH_SIZE] for i in range(0, len(tasks), BATCH_SIZE)]
+    logger.info(
+        f"Queued {len(tasks)} PDFs in {len(batches)} requests | "
+        f"batch_size={BATCH_SIZE} | workers={MAX_WORKERS}"
+    )
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(extract_batch, model, batch) for batch in batches]
+
+        try:
+            with tqdm(total=len(tasks), desc="Extracting invoices", unit="file") as progress:
+                for future in as_completed(futures):
+                    results = future.result()
+                    for result in results:
+                        if result is not None:
+                            success_count += 1
+                        else:
+                            fail_count += 1
+                    progress.update(len(results))
+
+        except KeyboardInterrupt:
+            # Without cancel_futures, leaving the with-block would wait for every
+            # queued batch to be sent. Only the calls already in flight finish.
+            logger.warning("Interrupted by user | cancelling queued requests...")
+            executor.shutdown(wait=True, cancel_futures=True)
+            logger.warning(
+                f"Stopped early | extracted={success_count} | failed={fail_count} | "
+                f"not attempted={len(tasks) - success_count - fail_count} (rerun to resume)"
+            )
+            raise
+
+    return success_count, fail_count
 
 
 # ============================================================================
@@ -327,23 +1056,62 @@ def extract_single_invoice(
 # ============================================================================
 
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Generate silver labels with Gemini.")
+    parser.add_argument(
+        "--mode",
+        choices=["online", "batch"],
+        default="online",
+        help="online: concurrent generate_content calls; batch: one Vertex AI Batch Prediction job.",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Call Gemini once per near-duplicate template class (layout hash) and copy "
+        "the label to the other members.",
+    )
+    parser.add_argument(
+        "--batch-job",
+        default=None,
+        help="Collect the output of an existing Batch Prediction job (resource name) "
+        "instead of submitting a new one. Implies --mode=batch.",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Also retry PDFs whose last recorded failure in failed.jsonl was permanent "
+        "(JSON parse or unexpected error).",
+    )
+    return parser.parse_args()
+
+
 def main() -> None:
     """
     Main batch processing loop.
 
     1. Initialize Vertex AI
     2. Collect PDFs from ./templates
-    3. For each PDF, call Gemini and save the JSON to ./silver_labels
-    4. Skip files that already have a corresponding JSON output (resume support)
-    5. Track progress with tqdm, log failures to file
+    3. Skip files that already have a corresponding JSON output (resume support)
+       or whose last recorded failure was permanent (unless --retry-failed);
+       with --dedup, also skip non-representative members of each template class
+       (a representative that failed permanently is replaced by a member)
+    4. Call Gemini for the remaining PDFs, either concurrently online
+       (MAX_WORKERS threads, BATCH_SIZE PDFs per request) or as one Vertex AI
+       Batch Prediction job (--mode=batch), and save each JSON to ./silver_labels
+    5. With --dedup, copy representative labels to their class members
+    6. Track progress with tqdm, log failures to file
     """
+    args = parse_args()
+    if args.batch_job:
+        args.mode = "batch"
+
     logger.info("=" * 60)
     logger.info("SILVER LABEL GENERATION — Phase 1, Task 2")
     logger.info(f"Started at {datetime.now().isoformat()}")
     logger.info("=" * 60)
 
     # --- Step 1: Init ---
-    init_vertex_ai()
+    credentials = init_vertex_ai()
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
     # --- Step 2: Collect PDFs ---
@@ -354,32 +1122,63 @@ def main() -> None:
 
     # --- Step 3: Initialize model ---
     model = GenerativeModel(MODEL_ID)
-    logger.info(f"Model loaded: {MODEL_ID}")
+    logger.info(f"Model loaded: {MODEL_ID} | mode={args.mode}")
 
     # --- Step 4: Batch process ---
-    success_count = 0
     skip_count = 0
-    fail_count = 0
+    prior_failure_count = 0
+    duplicate_count = 0
+
+    failure_history.update(load_failure_history())
+
+    classes = group_templates(pdf_files) if args.dedup else {}
+
+    done = list_existing_labels()
+
+    if args.dedup:
+        promote_representatives(classes, done, args.retry_failed)
+
+    tasks: list[tuple[pathlib.Path, pathlib.Path]] = []
+    for pdf_path in pdf_files:
+        # Only class representatives go to Gemini; members get a copy later
+        if classes.get(pdf_path, pdf_path) != pdf_path:
+            duplicate_count += 1
+            continue
 
-    for pdf_path in tqdm(pdf_files, desc="Extracting invoices", unit="file"):
         # Build output path
         output_path = OUTPUT_DIR / pdf_path.with_suffix(".json").name
 
         # Resume support: skip if output already exists
-        if output_path.exists():
+        if output_path.name in done:
             skip_count += 1
             continue
 
-        # Extract
-        result = extract_single_invoice(model, pdf_path)
+        last_failure = failure_history.get(pdf_path.name)
+        if (
+            not args.retry_failed
+            and last_failure is not None
+            and last_failure["error_type"] in PERMANENT_FAILURE_TYPES
+        ):
+            prior_failure_count += 1
+            continue
 
-        if result is not None:
-            # Save JSON
-            with open(output_path, "w", encoding="utf-8") as f:
-                json.dump(result, f, indent=2, ensure_ascii=False)
-            success_count += 1
-        else:
-            fail_count += 1
+        tasks.append((pdf_path, output_path))
+
+    if args.mode == "batch" and (tasks or args.batch_job or BATCH_JOB_STATE.exists()):
+        success_count, fail_count = run_batch_prediction(tasks, credentials, args.batch_job)
+    elif not tasks or args.mode == "batch":
+        success_count, fail_count = 0, 0
+    else:
+        success_count, fail_count = run_online(model, tasks)
+
+    copied_count = propagate_labels(classes) if args.dedup else 0
+    if args.dedup:
+        # Members whose representative has no label yet (failed or still pending)
+        done = list_existing_labels()
+        unlabeled_duplicates = sum(
+            1 for member, rep in classes.items()
+            if member != rep and member.with_suffix(".json").name not in done
+        )
 
     # --- Step 5: Summary ---
     logger.info("=" * 60)
@@ -387,10 +1186,17 @@ def main() -> None:
     logger.info(f"  Total PDFs   : {len(pdf_files)}")
     logger.info(f"  Extracted    : {success_count}")
     logger.info(f"  Skipped      : {skip_count}")
+    if prior_failure_count > 0:
+        logger.info(f"  Prev. failed : {prior_failure_count} (rerun with --retry-failed)")
+    if args.dedup:
+        logger.info(f"  Duplicates   : {duplicate_count} ({copied_count} labels copied)")
+        if unlabeled_duplicates > 0:
+            logger.info(f"  Unlabeled dup: {unlabeled_duplicates} (representative has no label)")
     logger.info(f"  Failed       : {fail_count}")
     logger.info(f"  Output dir   : {OUTPUT_DIR.resolve()}")
     if fail_count > 0:
         logger.info(f"  Failure log  : {FAILED_LOG.resolve()}")
+        logger.info(f"  Failure JSONL: {FAILED_JSONL.resolve()}")
     logger.info("=" * 60)
 
 
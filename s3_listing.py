@@ -0,0 +1,248 @@
+"""
+Concurrent S3 listing shared by count.py and unique_template_discovery.py.
+
+list_objects_v2 returns at most 1000 keys per round trip, so a sequential
+paginator is bound by RTT x pages. Here the key space under a prefix is cut
+into contiguous key ranges (split on the first character after the prefix)
+and every range is paginated on its own thread using StartAfter. The ranges
+are half-open on the left, so together they cover every key exactly once,
+including keys that do not start with an alphanumeric character.
+
+If an S3 Inventory report (Parquet) is configured, read_inventory_keys() and
+count_inventory_keys() read one delivery's manifest data files instead, so no
+LIST requests are issued at all.
+"""
+
+import re
+import json
+import queue
+import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.config import Config
+
+LIST_WORKERS = 16
+
+# botocore defaults to 10 pooled connections, fewer than the listing and
+# download threads combined; keep-alive reuses TLS sessions across GETs.
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+)
+
+# Must be sorted in code-point order, which matches S3's UTF-8 byte order.
+SHARD_BOUNDARIES = sorted(string.digits + string.ascii_uppercase + string.ascii_lowercase)
+
+
+def _shard_ranges(prefix):
+    """Return (start_after, last_key) pairs; None means unbounded."""
+    bounds = [prefix + c for c in SHARD_BOUNDARIES]
+    lowers = [None] + bounds
+    uppers = bounds + [None]
+    return list(zip(lowers, uppers))
+
+
+def _list_shard(s3, bucket, prefix, start_after, last_key, on_page, stop_event=None):
+    paginator = s3.get_paginator('list_objects_v2')
+    params = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after is not None:
+        params['StartAfter'] = start_after
+
+    for page in paginator.paginate(**params):
+        if stop_event is not None and stop_event.is_set():
+            return
+        contents = page.get('Contents', [])
+        if last_key is not None:
+            in_range = [obj for obj in contents if obj['Key'] <= last_key]
+            if in_range:
+                on_page(in_range)
+            if len(in_range) < len(contents):
+                return  # Walked into the next shard's range
+        elif contents:
+            on_page(contents)
+
+
+def list_objects_sharded(s3, bucket, prefix, on_page, max_workers=LIST_WORKERS,
+                         stop_event=None):
+    """
+    List every object under `prefix`, calling on_page(contents) once per page.
+
+    on_page is invoked from worker threads, so it must be thread-safe. Pages
+    arrive in no particular order across shards. Setting stop_event makes
+    every shard return before its next LIST request.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(_list_shard, s3, bucket, prefix, start_after, last_key,
+                        on_page, stop_event)
+            for start_after, last_key in _shard_ranges(prefix)
+        ]
+        for future in futures:
+            future.result()  # Surface listing errors to the caller
+
+
+def iter_keys_sharded(s3, bucket, prefix, key_filter=None, max_workers=LIST_WORKERS,
+                      buffer_size=10000):
+    """
+    Yield keys under `prefix` (optionally filtered) as the shards list them.
+
+    Listing runs on a background thread and feeds a bounded queue, so the
+    caller can start working on the first page instead of waiting for the
+    whole bucket. Keys arrive unsorted. Closing the generator (or breaking
+    out of a for loop over it) stops the shards before their next LIST.
+    """
+    keys = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    done = object()
+    errors = []
+
+    def put(item):
+        # Never block forever on a full queue once the consumer has gone
+        while not stop.is_set():
+            try:
+                keys.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def collect(contents):
+        for obj in contents:
+            if key_filter is None or key_filter(obj['Key']):
+                put(obj['Key'])
+
+    def run():
+        try:
+            list_objects_sharded(s3, bucket, prefix, collect, max_workers=max_workers,
+                                 stop_event=stop)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(done)
+
+    threading.Thread(target=run, name="s3-listing", daemon=True).start()
+    try:
+        while True:
+            key = keys.get()
+            if key is done:
+                break
+            yield key
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+
+
+# Dated delivery folders look like 2024-05-01T01-00Z; they sort chronologically
+_INVENTORY_DELIVERY_RE = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z$")
+
+
+def _resolve_inventory_manifest(filesystem, path):
+    """
+    Return the manifest.json path for an inventory URI.
+
+    `path` is either a manifest.json itself or the inventory configuration
+    prefix (destination/source-bucket/config-id), in which case the latest
+    dated delivery folder is used.
+    """
+    from pyarrow import fs
+
+    if path.endswith("manifest.json"):
+        return path
+
+    deliveries = [
+        info.path for info in filesystem.get_file_info(fs.FileSelector(path.rstrip("/")))
+        if info.type == fs.FileType.Directory
+        and _INVENTORY_DELIVERY_RE.match(info.base_name)
+    ]
+    if not deliveries:
+        raise FileNotFoundError(f"No dated inventory deliveries found under {path}")
+    return max(deliveries) + "/manifest.json"
+
+
+def _read_inventory_key_column(inventory_uri, prefix, access_key, secret_key):
+    """
+    Return the unique live keys under `prefix` from one S3 Inventory report,
+    as an Arrow array.
+
+    inventory_uri is either a delivery's manifest.json, e.g.
+    s3://inventory-bucket/source-bucket/config-id/2024-05-01T01-00Z/manifest.json,
+    or the configuration prefix s3://inventory-bucket/source-bucket/config-id/
+    to use the latest delivery. Only the data files listed in that manifest
+    are read: data/ accumulates files from every retained delivery.
+    """
+    # Optional dependency: only needed when an inventory report is configured
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    from pyarrow import fs
+
+    filesystem, path = fs.FileSystem.from_uri(inventory_uri)
+    if isinstance(filesystem, fs.S3FileSystem) and access_key:
+        filesystem = fs.S3FileSystem(access_key=access_key, secret_key=secret_key,
+                                     region=filesystem.region)
+
+    manifest_path = _resolve_inventory_manifest(filesystem, path)
+    with filesystem.open_input_stream(manifest_path) as f:
+        manifest = json.loads(f.read())
+
+    file_format = manifest.get("fileFormat")
+    if file_format != "Parquet":
+        raise ValueError(
+            f"Inventory report {manifest_path} is {file_format}; "
+            "only Parquet inventory reports are supported"
+        )
+
+    # destinationBucket is an ARN: arn:aws:s3:::inventory-bucket
+    destination_bucket = manifest["destinationBucket"].rsplit(":", 1)[-1]
+    data_files = [f"{destination_bucket}/{entry['key']}" for entry in manifest["files"]]
+
+    dataset = ds.dataset(data_files, format='parquet', filesystem=filesystem)
+    columns = dataset.schema.names
+
+    condition = pc.starts_with(ds.field('key'), pattern=prefix) if prefix else None
+    # Versioned buckets list every version; keep only live current objects
+    if 'is_latest' in columns:
+        latest = ds.field('is_latest') == True  # noqa: E712 (Arrow expression)
+        condition = latest if condition is None else condition & latest
+    if 'is_delete_marker' in columns:
+        live = ds.field('is_delete_marker') == False  # noqa: E712 (Arrow expression)
+        condition = live if condition is None else condition & live
+
+    keys = dataset.to_table(columns=['key'], filter=condition).column('key')
+    # Safety net against overlapping data files within a report
+    return pc.unique(keys)
+
+
+def _pdf_mask(keys):
+    import pyarrow.compute as pc
+
+    return pc.ends_with(pc.utf8_lower(keys), '.pdf')
+
+
+def read_inventory_keys(inventory_uri, prefix="", pdf_only=False,
+                        access_key=None, secret_key=None):
+    """
+    Return keys under `prefix` from one S3 Inventory Parquet report, sorted.
+
+    See _read_inventory_key_column() for the accepted inventory_uri forms.
+    Filtering runs in Arrow, so only the matching keys are materialized as
+    Python strings.
+    """
+    keys = _read_inventory_key_column(inventory_uri, prefix, access_key, secret_key)
+    if pdf_only:
+        keys = keys.filter(_pdf_mask(keys))
+    return sorted(keys.to_pylist())
+
+
+def count_inventory_keys(inventory_uri, prefix="", access_key=None, secret_key=None):
+    """
+    Return (total objects, PDF objects) under `prefix` from one inventory report.
+
+    Counting stays in Arrow; no key is converted to a Python string.
+    """
+    import pyarrow.compute as pc
+
+    keys = _read_inventory_key_column(inventory_uri, prefix, access_key, secret_key)
+    pdf_count = pc.sum(_pdf_mask(keys)).as_py() or 0  # sum of an empty array is null
+    return len(keys), pdf_count
@@ -0,0 +1,111 @@
+"""
+Perceptual hashing of invoice layouts, shared by unique_template_discovery.py
+(deduplicating S3 PDFs into templates) and generate_silver_labels.py
+(grouping near-duplicate templates before calling Gemini).
+
+Hashes are 64-bit difference hashes (dHash) of the first page, stored as
+plain ints so the BK-tree distance is a single XOR + popcount. dHash compares
+adjacent pixels of a 9x8 grayscale thumbnail, which skips pHash's DCT and is
+often more robust to rendering artifacts for layout matching. The cache and
+some variable names still say "phash" for historical reasons.
+"""
+
+import os
+import json
+import imagehash
+import pybktree
+from PIL import Image
+from pdf2image import convert_from_bytes, convert_from_path
+
+try:
+    import pypdfium2 as pdfium  # In-process renderer; avoids a pdftoppm subprocess per PDF
+except ImportError:
+    pdfium = None
+
+HASH_THRESHOLD = 12
+RENDER_DPI = 72  # The hash works on a 9x8 thumbnail; poppler's 200 DPI default is wasted work
+PHASH_CACHE_FILENAME = ".phash_cache.json"
+HASH_ALGORITHM = "dhash"  # Stored per cache entry; hashes from other algorithms are recomputed
+
+def hash_to_int(h):
+    """Pack a 64-bit ImageHash into a plain int for fast XOR/popcount."""
+    return int(str(h), 16)
+
+def hamming_distance(a, b):
+    # C-level XOR + popcount instead of ImageHash.__sub__'s per-bit numpy compare
+    return (a ^ b).bit_count()
+
+def new_template_index():
+    """Empty BK-tree keyed on Hamming distance between int hashes."""
+    # Lookups within HASH_THRESHOLD prune most of the tree instead of
+    # comparing against every known template.
+    return pybktree.BKTree(hamming_distance, [])
+
+def load_phash_cache(cache_path):
+    """Load {filename: {"mtime", "size", "phash"}} saved by previous runs."""
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_phash_cache(cache, cache_path):
+    # Write-then-rename so an interrupted run never leaves a truncated cache
+    tmp_path = str(cache_path) + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+def cache_phash(cache, path, phash):
+    stat = os.stat(path)
+    cache[os.path.basename(path)] = {
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "phash": f"{phash:016x}",
+        "algo": HASH_ALGORITHM,
+    }
+
+def cached_phash(cache, path):
+    """Return the cached int hash if the file is unchanged since it was hashed."""
+    entry = cache.get(os.path.basename(path))
+    if entry is None:
+        return None
+    stat = os.stat(path)
+    if entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+        return None
+    # Entries written before the switch to dHash have no "algo" and are pHashes
+    if entry.get("algo", "phash") != HASH_ALGORITHM:
+        return None
+    return int(entry["phash"], 16)
+
+def render_first_page(source):
+    """Render page 1 of a complete PDF (bytes or local path) to a PIL image, or None."""
+    if pdfium is not None:
+        try:
+            pdf = pdfium.PdfDocument(source)
+            try:
+                if len(pdf) == 0:
+                    return None
+                return pdf[0].render(scale=RENDER_DPI / 72).to_pil()
+            finally:
+                pdf.close()
+        except pdfium.PdfiumError:
+            pass # Fall back to poppler for files pdfium cannot open
+
+    if isinstance(source, (bytes, bytearray)):
+        images = convert_from_bytes(source, first_page=1, last_page=1, fmt='jpeg',
+                                    dpi=RENDER_DPI, thread_count=1)
+    else:
+        images = convert_from_path(source, first_page=1, last_page=1, fmt='jpeg',
+                                   dpi=RENDER_DPI, thread_count=1)
+    return images[0] if images else None
+
+def compute_template_hash(source):
+    """Return the int dHash of page 1 (complete PDF bytes or local path), or None."""
+    image = render_first_page(source)
+    if image is None:
+        return None
+    # 9x8 grayscale thumbnail -> 8x8 adjacent-pixel comparisons = 64 bits,
+    # the same width as the old pHash so HASH_THRESHOLD stays comparable
+    thumbnail = image.convert('L').resize((9, 8), Image.BILINEAR)
+    return hash_to_int(imagehash.dhash(thumbnail, hash_size=8))
@@ -1,20 +1,34 @@
 import os
 import gc
 import boto3
-import imagehash
-from pdf2image import convert_from_bytes, convert_from_path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import islice
 from tqdm import tqdm
 from dotenv import load_dotenv
 
+from s3_listing import S3_CLIENT_CONFIG, iter_keys_sharded, read_inventory_keys
+from template_hashing import (
+    HASH_THRESHOLD, PHASH_CACHE_FILENAME, cache_phash, cached_phash, compute_template_hash,
+    load_phash_cache, new_template_index, save_phash_cache,
+)
+
 # Load environment variables
 load_dotenv()
 
 # --- CONFIGURATION BLOCK ---
 BUCKET_NAME = os.getenv("S3_BUCKET_NAME", "fink-hotel-invoice-scraped")
 S3_PREFIX = os.getenv("S3_PREFIX", "")
+S3_INVENTORY_URI = os.getenv("S3_INVENTORY_URI")  # Optional inventory manifest.json or config prefix; replaces LIST
 TARGET_LIMIT = 1000
 TEMPLATES_DIR = "./templates"
-HASH_THRESHOLD = 12
+PHASH_CACHE_PATH = os.path.join(TEMPLATES_DIR, PHASH_CACHE_FILENAME)
+DOWNLOAD_WORKERS = 16                 # Network-bound S3 GETs
+RENDER_WORKERS = os.cpu_count() or 1  # CPU-bound poppler renders
+# Every queued key holds a whole PDF (and a pickled copy on its way to a
+# render process), so keep just enough in flight to feed both pools.
+MAX_IN_FLIGHT = DOWNLOAD_WORKERS + RENDER_WORKERS
+GC_INTERVAL = 100                     # Objects between cycle collections (M1 unified memory)
 # ---------------------------
 
 AWS_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID")
@@ -24,9 +38,47 @@ def get_s3_client():
     return boto3.client(
         's3',
         aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        config=S3_CLIENT_CONFIG,
     )
 
+def fetch_and_hash(s3, render_pool, key):
+    """
+    Download worker: fetch the whole PDF in one GET and hand it to the render pool.
+
+    A truncated head is never hashed: pdfium happily rebuilds the xref and
+    draws a page with its (usually scanned) image missing, and that
+    near-blank page would match every other large scan.
+    """
+    response = s3.get_object(Bucket=BUCKET_NAME, Key=key)
+    pdf_bytes = response['Body'].read()
+    return pdf_bytes, render_pool.submit(compute_template_hash, pdf_bytes)
+
+def iter_candidate_keys(s3):
+    """
+    Yield S3 PDF keys that are not already saved locally (inventory or sharded LIST).
+
+    With LIST, keys stream in while the shards are still paginating; closing
+    the generator stops the listing.
+    """
+    if S3_INVENTORY_URI:
+        pdf_keys = read_inventory_keys(S3_INVENTORY_URI, prefix=S3_PREFIX, pdf_only=True,
+                                       access_key=AWS_ACCESS_KEY_ID,
+                                       secret_key=AWS_SECRET_ACCESS_KEY)
+    else:
+        pdf_keys = iter_keys_sharded(s3, BUCKET_NAME, S3_PREFIX,
+                                     key_filter=lambda key: key.lower().endswith('.pdf'))
+
+    # FAST SKIP: If we already downloaded this exact file, skip the S3 GET request
+    local_names = set(os.listdir(TEMPLATES_DIR))
+    try:
+        for key in pdf_keys:
+            if os.path.basename(key) not in local_names:
+                yield key
+    finally:
+        if hasattr(pdf_keys, 'close'):
+            pdf_keys.close()
+
 def main():
     if not os.path.exists(TEMPLATES_DIR):
         os.makedirs(TEMPLATES_DIR)
@@ -37,28 +89,41 @@ def main():
         print(f"Failed to initialize S3 client: {e}")
         return
 
-    unique_template_hashes = []
+    # BK-tree of int layout hashes (see template_hashing)
+    unique_template_hashes = new_template_index()
+    downloaded_count = 0
     
     # ==========================================
     # PHASE 0: BOOTSTRAP (RESUME LOGIC)
     # ==========================================
     existing_files = [f for f in os.listdir(TEMPLATES_DIR) if f.lower().endswith('.pdf')]
+    phash_cache = load_phash_cache(PHASH_CACHE_PATH)
     
     if existing_files:
         print(f"🔄 Found {len(existing_files)} existing templates locally. Hashing to resume...")
+        live_cache = {}
         for filename in tqdm(existing_files, desc="Bootstrapping local files"):
             try:
                 path = os.path.join(TEMPLATES_DIR, filename)
-                # Convert local file
-                images = convert_from_path(path, first_page=1, last_page=1, fmt='jpeg')
-                if images:
-                    # Using hash_size=8 strictly to match the S3 hashes (64-bit)
-                    h = imagehash.phash(images[0], hash_size=8)
-                    unique_template_hashes.append(h)
+
+                # Reuse the stored hash unless the file changed since it was cached
+                h = cached_phash(phash_cache, path)
+                if h is None:
+                    # Render and hash local file
+                    h = compute_template_hash(path)
+                    if h is None:
+                        continue
+
+                unique_template_hashes.add(h)
+                cache_phash(live_cache, path, h)
+                downloaded_count += 1
             except Exception as e:
                 pass # Skip silently if a local file is corrupted
+
+        # Drops entries for templates that were deleted since the last run
+        phash_cache = live_cache
+        save_phash_cache(phash_cache, PHASH_CACHE_PATH)
                 
-    downloaded_count = len(unique_template_hashes)
     print(f"\n✅ Ready! Starting S3 scan with {downloaded_count} unique templates already in memory.")
 
     if downloaded_count >= TARGET_LIMIT:
@@ -68,70 +133,76 @@ def main():
     # ==========================================
     # PHASE 1: S3 DISCOVERY
     # ==========================================
-    paginator = s3.get_paginator('list_objects_v2')
-    page_iterator = paginator.paginate(Bucket=BUCKET_NAME, Prefix=S3_PREFIX)
+    # Listing (threads) feeds downloads (threads), which overlap with renders
+    # (processes); the uniqueness check stays on the main thread and consumes
+    # results in the order keys were listed.
+    pending = deque()
+    saved_names = set(existing_files)
+    key_iter = iter_candidate_keys(s3)
 
     try:
-        for page in page_iterator:
-            if 'Contents' not in page:
-                continue
-
-            for obj in tqdm(page['Contents'], desc="Scanning S3"):
-                if downloaded_count >= TARGET_LIMIT:
-                    print(f"\n🎯 Target limit of {TARGET_LIMIT} templates reached. Discovery complete.")
-                    return
-
-                key = obj['Key']
-                if not key.lower().endswith('.pdf'):
-                    continue
-
-                filename = os.path.basename(key)
-                local_path = os.path.join(TEMPLATES_DIR, filename)
-
-                # FAST SKIP: If we already downloaded this exact file, skip the S3 GET request
-                if os.path.exists(local_path):
-                    continue
-
-                try:
-                    # Stream PDF bytes into memory
-                    response = s3.get_object(Bucket=BUCKET_NAME, Key=key)
-                    pdf_bytes = response['Body'].read()
-                    
-                    images = convert_from_bytes(pdf_bytes, first_page=1, last_page=1, fmt='jpeg')
-                    
-                    if not images:
+        print("📜 Listing S3 bucket...")
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as dl_pool, \
+                ProcessPoolExecutor(max_workers=RENDER_WORKERS) as render_pool:
+
+            def fill_pipeline():
+                for key in islice(key_iter, MAX_IN_FLIGHT - len(pending)):
+                    pending.append((key, dl_pool.submit(fetch_and_hash, s3, render_pool, key)))
+
+            fill_pipeline()
+            with tqdm(desc="Scanning S3", unit="pdf") as progress:
+                while pending:
+                    key, dl_future = pending.popleft()
+                    fill_pipeline()
+                    progress.update(1)
+
+                    # Refcounting frees each PDF as soon as it leaves scope; a full
+                    # cycle sweep is only worth it occasionally, never per object.
+                    if progress.n % GC_INTERVAL == 0:
+                        gc.collect()
+
+                    try:
+                        pdf_bytes, hash_future = dl_future.result()
+                        phash = hash_future.result()
+                    except Exception:
+                        continue
+
+                    if phash is None:
                         continue
-                        
-                    phash = imagehash.phash(images[0], hash_size=8)
 
                     # Check for uniqueness against existing memory
-                    is_unique = True
-                    for existing_hash in unique_template_hashes:
-                        if phash - existing_hash <= HASH_THRESHOLD:
-                            is_unique = False
-                            break
-                    
-                    if is_unique:
-                        unique_template_hashes.append(phash)
-                        downloaded_count += 1
-                        
-                        # Save the new template
-                        with open(local_path, 'wb') as f:
-                            f.write(pdf_bytes)
-
-                except Exception:
-                    pass
-                finally:
-                    # Explicit memory management for M1 Unified Memory
-                    if 'pdf_bytes' in locals(): del pdf_bytes
-                    if 'images' in locals(): del images
-                    if 'response' in locals(): del response
-                    gc.collect()
+                    if unique_template_hashes.find(phash, HASH_THRESHOLD):
+                        continue
+
+                    # Another in-flight key with the same basename may have been saved already
+                    filename = os.path.basename(key)
+                    if filename in saved_names:
+                        continue
+
+                    unique_template_hashes.add(phash)
+                    downloaded_count += 1
+                    saved_names.add(filename)
+
+                    # Save the new template
+                    local_path = os.path.join(TEMPLATES_DIR, filename)
+                    with open(local_path, 'wb') as f:
+                        f.write(pdf_bytes)
+                    cache_phash(phash_cache, local_path, phash)
+                    save_phash_cache(phash_cache, PHASH_CACHE_PATH)
+
+                    if downloaded_count >= TARGET_LIMIT:
+                        print(f"\n🎯 Target limit of {TARGET_LIMIT} templates reached. Discovery complete.")
+                        key_iter.close()
+                        for _, future in pending:
+                            future.cancel()
+                        break
 
     except KeyboardInterrupt:
         print(f"\n⏸️ Process interrupted by user. Saved {downloaded_count} templates so far. Run again to resume.")
     except Exception as e:
         print(f"\n❌ An error occurred: {e}")
+    finally:
+        key_iter.close()  # Stops any shard still listing
 
     print(f"\n🏁 Finished. Total unique templates in '{TEMPLATES_DIR}': {downloaded_count}")
 